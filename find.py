@@ -1,7 +1,10 @@
 #!/usr/bin/python3
 
+import mmap
+import re
 import sys
-from dataclasses import dataclass
+from contextlib import nullcontext
+from dataclasses import dataclass, field
 from typing import *
 from enum import Enum, auto
 from abc import ABC, abstractmethod
@@ -14,20 +17,26 @@ class TokenType(Enum):
     LPAREN=auto()
     RPAREN=auto()
 
+# Node kinds; plain ints so that dispatch in the hot paths is a single compare
+K_REPLACE = 0
+K_STRING  = 1
+K_CONCAT  = 2
+
 # </enums>
 
 # <classes>
 
-Error = str # TODO: proper error reporting (replace "str" with a custom class "Error" or something)
-ParseResult = Tuple[Optional["Node"], Optional[Error]]
-RuntimeResult = Tuple[Optional[Any], Optional[Error]]
+class FindError(Exception):
+    """Raised by the lexer, parser and evaluator; the message is shown to the user as-is"""
+
+InputBuffer = Union[bytes, mmap.mmap]
 
 @dataclass
 class Flags:
     debug: bool = False
 flags = Flags() # global variable, oh no
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Token:
     type_: TokenType
     value: Union[str, None] = None
@@ -38,114 +47,136 @@ class Token:
             return f"{result}:{repr(self.value)}"
         return result
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Node(ABC):
+    KIND: ClassVar[int]
+    # Set when the node's value doesn't depend on the input, so visit() can skip the work
+    const_value: Optional[bytes] = field(default=None, init=False, repr=False, compare=False)
+
     @abstractmethod
     def __repr__(self) -> str:
         ...
 
     @abstractmethod
-    def visit(self, input_: str) -> RuntimeResult:
+    def visit(self, input_: InputBuffer) -> bytes:
         ...
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ReplaceNode(Node):
+    KIND: ClassVar[int] = K_REPLACE
     query: Node
     replacement: Node
 
     def __repr__(self) -> str:
         return f"({self.query}) -> ({self.replacement})"
     
-    def visit(self, input_: str) -> RuntimeResult:
-        val, err = self.query.visit(input_)
-        if err is not None: return None, err
-        assert val is not None
-        if not isinstance(val, str):
-            return None, "wrong data type for query; expected string"
-
-        idx: int = input_.find(val)
-        idx_end: int = idx + len(val)
-
-        rep, err = self.replacement.visit(input_)
-        if err is not None: return None, err
-        assert rep is not None
-        if not isinstance(rep, str):
-            return None, "wrong data type for replacement; expected string"
-        
-        return input_[:idx] + rep + input_[idx_end:], None
+    def visit(self, input_: InputBuffer) -> bytes:
+        val = self.query.visit(input_)
+        rep = self.replacement.visit(input_)
+        return replace_once(input_, val, rep)
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class StringNode(Node):
+    KIND: ClassVar[int] = K_STRING
     tok: Token
 
-    def __new__(cls, tok: Token) -> "StringNode":
-        assert tok.type_ == TokenType.STRING, "This could be a bug in the parser"
-        assert tok.value is not None, "This could be a bug in the lexer"
-        return object.__new__(cls)
+    # Nodes are immutable, so every occurrence of a literal can share one
+    _CACHE: ClassVar[Dict[str, "StringNode"]] = {}
+
+    @classmethod
+    def make(cls, tok: Token) -> "StringNode":
+        value = cast(str, tok.value)
+        node = cls._CACHE.get(value)
+        if node is None:
+            node = cls._CACHE[value] = cls(tok)
+        return node
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "const_value", cast(str, self.tok.value).encode("utf-8"))
 
     def __repr__(self) -> str:
-        assert self.tok.value is not None, "This could be a bug in the StringNode.__new__() method"
         return repr(self.tok)
     
-    def visit(self, input_: str) -> RuntimeResult:
-        assert isinstance(self.tok.value, str)
-        return self.tok.value, None
+    def visit(self, input_: InputBuffer) -> bytes:
+        return cast(bytes, self.const_value)
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ConcatNode(Node):
-    nodes: List[Node]
+    KIND: ClassVar[int] = K_CONCAT
+    nodes: Tuple[Node, ...]
+
+    def __post_init__(self) -> None:
+        if all(node.const_value is not None for node in self.nodes):
+            object.__setattr__(self, "const_value", b"".join(cast(bytes, node.const_value) for node in self.nodes))
 
     def __repr__(self) -> str:
         return "(" + " ".join(map(repr, self.nodes)) + ")"
     
-    def visit(self, input_: str) -> RuntimeResult:
-        res = ""
+    def visit(self, input_: InputBuffer) -> bytes:
+        if self.const_value is not None: return self.const_value
+        parts: List[bytes] = []
         for node in self.nodes:
-            val, err = node.visit(input_)
-            if err is not None: return None, err
-            assert val is not None
-
-            res += str(val)
-        return res, None
+            if node.KIND == K_STRING:
+                parts.append(cast(bytes, node.const_value))
+            else:
+                parts.append(node.visit(input_))
+        return b"".join(parts)
 
 # </classes>
 
-def lex_string(it: Iterator[str]) -> Tuple[Optional[Token], Optional[Error]]:
-    string: str = ""
-    for char in it:
-        assert len(char) == 1, "This could be a bug in the lexer"
-        if char == '"': break # TODO: escaping
-        string += char
-    else: # no break
-        return None, "EOF while parsing string, did you forget a '\"'?"
-    return Token(TokenType.STRING, string), None
-
-single_char_toks: Dict[str, TokenType] = {
-    "(": TokenType.LPAREN,
-    ")": TokenType.RPAREN,
+def replace_once(buf: InputBuffer, query: bytes, rep: bytes) -> bytes:
+    start = buf.find(query)
+    if start == -1:
+        return bytes(buf)
+    end = start + len(query)
+    # Joining memoryview slices copies each byte of the result exactly once,
+    # instead of allocating the slices and an intermediate concatenation first
+    with memoryview(buf) as view:
+        return b"".join((view[:start], rep, view[end:]))
+
+def write_replaced(out: BinaryIO, buf: InputBuffer, query: bytes, rep: bytes) -> None:
+    """Like replace_once(), but writes the pieces to `out` straight from `buf` instead of building the result"""
+    start = buf.find(query)
+    # The slices are only alive for the duration of each write(), so `view` can be released
+    # (and a mapping behind `buf` closed) as soon as we're done
+    with memoryview(buf) as view:
+        if start == -1:
+            out.write(view)
+            return
+        out.write(view[:start])
+        out.write(rep)
+        out.write(view[start + len(query):])
+
+# Whitespace is skipped by the leading \s* so it never costs a loop iteration. Trailing whitespace
+# needs the final \s+\Z alternative (which matches no group): without it, finditer would retry the
+# failing \s* scan from every trailing position, which is quadratic in the length of the run.
+# Character classes compile to lookup bitmaps inside the regex engine
+TOKEN_RE: Pattern[str] = re.compile(r'\s*(?:"([^"]*)"|(->|[()])|(\S))|\s+\Z')
+
+# These tokens carry no value and are immutable, so the lexer hands out the same instances every time
+SYMBOL_TOKENS: Dict[str, Token] = {
+    "->": Token(TokenType.ARROW),
+    "(":  Token(TokenType.LPAREN),
+    ")":  Token(TokenType.RPAREN),
 }
 
-def lex(code: str) -> Generator[Token, None, Optional[Error]]:
-    it = iter(code)
-    for char in it:
-        if char.isspace():
-            pass
-        elif char in single_char_toks:
-            yield Token(single_char_toks[char])
-        elif char == '"':
-            tok, err = lex_string(it)
-            if err is not None:
-                return err
-            assert isinstance(tok, Token), "This could be a bug in the lex_string() function"
-            yield tok
-        elif char == "-":
-            char = next(it)
-            if char != ">":
-                return "Expected '>' (after '-')"
-            yield Token(TokenType.ARROW)
-        else:
-            return f"Unknown character '{char}'"
-    return None
+def lex(code: str) -> List[Token]:
+    out: List[Token] = []
+    for m in TOKEN_RE.finditer(code):
+        group = m.lastindex
+        if group == 1:
+            # interned so that repeated literals share one object (and hash/compare cheaply in StringNode._CACHE)
+            out.append(Token(TokenType.STRING, sys.intern(m.group(1)))) # TODO: escaping
+        elif group == 2:
+            out.append(SYMBOL_TOKENS[m.group(2)])
+        elif group == 3:
+            char = m.group(3)
+            if char == '"':
+                raise FindError("EOF while parsing string, did you forget a '\"'?")
+            elif char == "-":
+                raise FindError("Expected '>' (after '-')")
+            raise FindError(f"Unknown character '{char}'")
+    return out
 
 TT_NAMES: Dict[TokenType, str] = {
     TokenType.ARROW:  "'->'",
@@ -161,49 +192,91 @@ def expect(expected: List[TokenType], actual: TokenType) -> str:
     return f"expected {human_chain(expected_type_names)}, but got {TT_NAMES[actual]}"
 
 def human_chain(elts: List[str], sep: str=", ", last_word: str="or") -> str:
-    result: str = ""
-    for i, elt in enumerate(elts):
-        result += elt
-        if i < len(elts) - 2:
-            result += sep
-        elif i == len(elts) - 2:
-            result += f" {last_word} "
-    return result
-
-def parse_expr(it: Iterator[Token], tok: Token) -> ParseResult:
-    if tok.type_ != TokenType.LPAREN and tok.type_ != TokenType.STRING:
-        return None, expect([TokenType.LPAREN, TokenType.STRING], tok.type_)
-    elif tok.type_ == TokenType.STRING:
-        return StringNode(tok), None
-    
-    nodes: List[Node] = []
-    while (tok := next(it)).type_ != TokenType.RPAREN:
-        node, err = parse_expr(it, tok)
-        if err is not None: return None, err
-        assert isinstance(node, Node)
+    if len(elts) <= 1:
+        return "".join(elts)
+    return sep.join(elts[:-1]) + f" {last_word} " + elts[-1]
 
-        nodes.append(node)
-    
-    return ConcatNode(nodes), None
+# Literals stay plain strings while parsing, so that only nodes which survive folding get built (and cached)
+ExprPart = Union[str, Node]
+
+def parse_expr(it: Iterator[Token], tok: Token) -> Node:
+    # One list of parts per open '(' so nesting depth isn't bounded by the recursion limit
+    stack: List[List[ExprPart]] = [[]]
+    while True:
+        if tok.type_ == TokenType.STRING:
+            stack[-1].append(cast(str, tok.value))
+        elif tok.type_ == TokenType.LPAREN:
+            stack.append([])
+        elif tok.type_ == TokenType.RPAREN and len(stack) > 1:
+            parts = stack.pop()
+            stack[-1].append(fold_concat(parts))
+        else:
+            raise FindError(expect([TokenType.LPAREN, TokenType.STRING], tok.type_))
 
-def parse(tokens: Iterable[Token]) -> ParseResult:
+        if len(stack) == 1:
+            part = stack[0][0]
+            return literal_node(part) if isinstance(part, str) else part
+        try:
+            tok = next(it)
+        except StopIteration:
+            raise FindError("EOF while parsing expression, did you forget a ')'?")
+
+def literal_node(value: str) -> StringNode:
+    return StringNode.make(Token(TokenType.STRING, value))
+
+def fold_concat(parts: List[ExprPart]) -> ExprPart:
+    """Merges runs of adjacent literals and unwraps single-part concatenations"""
+    # Every leaf in the current grammar is a literal, so this always folds down to one string.
+    # ConcatNode.visit() and the visit() branch in main() are only reachable once input-dependent
+    # nodes (`any_str`, variables; see README) exist
+    folded: List[Node] = []
+    run: List[str] = []
+    for part in parts:
+        if isinstance(part, str):
+            run.append(part)
+            continue
+        if run:
+            folded.append(literal_node("".join(run)))
+            run = []
+        folded.append(part)
+    if len(folded) == 0:
+        return "".join(run)
+    if run:
+        folded.append(literal_node("".join(run)))
+
+    if len(folded) == 1:
+        return folded[0]
+    return ConcatNode(tuple(folded))
+
+def parse(tokens: Iterable[Token]) -> ReplaceNode:
     it = iter(tokens)
-    query, err = parse_expr(it, next(it))
-    if err: return None, err
-    assert isinstance(query, Node)
+    try:
+        tok = next(it)
+    except StopIteration:
+        raise FindError("EOF while parsing query")
+    query = parse_expr(it, tok)
 
     try:
         tok = next(it)
     except StopIteration:
-        return None, "EOF while parsing replacement"
+        raise FindError("EOF while parsing replacement")
     if tok.type_ != TokenType.ARROW:
-        return None, expect([TokenType.ARROW], tok.type_)
+        raise FindError(expect([TokenType.ARROW], tok.type_))
 
-    replacement, err = parse_expr(it, next(it))
-    if err: return None, err
-    assert isinstance(replacement, Node)
+    try:
+        tok = next(it)
+    except StopIteration:
+        raise FindError("EOF while parsing replacement")
+    replacement = parse_expr(it, tok)
 
-    return ReplaceNode(query, replacement), None
+    return ReplaceNode(query, replacement)
+
+def map_input(file: BinaryIO) -> ContextManager[InputBuffer]:
+    """Maps `file` into memory, so that searching it reads straight from the page cache"""
+    try:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError): # empty files and pipes can't be mapped
+        return nullcontext(file.read())
 
 def error(msg: str) -> NoReturn:
     print(f"ERROR: {msg}")
@@ -245,7 +318,7 @@ def main(argv: List[str]):
     if len(argv) > 0:
         input_path, *argv = argv
         try:
-            input_file = open(input_path, "r")
+            input_file = open(input_path, "rb")
         except FileNotFoundError:
             error(f"cannot find file {input_path}")
     if input_file == sys.stdin:
@@ -253,37 +326,30 @@ def main(argv: List[str]):
     
     with open(code_path, "r") as f:
         code = f.read()
-        assert isinstance(code, str)
     
-    with input_file:
-        input_ = input_file.read()
-    
-    tokens: List[Token] = []
-    it = lex(code)
     try:
-        while True:
-            tok = next(it)
-            tokens.append(tok)
-    except StopIteration as e:
-        if e.value is not None:
-            error(e.value)
-    
-    if flags.debug:
-        print(f"[DEBUG] Lexer output: {tokens}")
-    
-    ast, err = parse(tokens)
-    if err is not None:
-        error(err)
-    if flags.debug:
-        print(f"[DEBUG] Parser output: {ast}")
-    assert isinstance(ast, Node)
-    
-    res, err = ast.visit(input_)
-    if err is not None:
-        error(err)
-    assert isinstance(res, str)
-    
-    print(res)
+        tokens = lex(code)
+        if flags.debug:
+            print(f"[DEBUG] Lexer output: {tokens}")
+
+        ast = parse(tokens)
+        if flags.debug:
+            print(f"[DEBUG] Parser output: {ast}")
+
+        query, replacement = ast.query, ast.replacement
+        with input_file, map_input(input_file) as input_:
+            if query.KIND == K_STRING and replacement.KIND == K_STRING:
+                # literal -> literal needs no tree walk at all. Constant folding makes this the only shape the current
+                # grammar produces; the visit() branch is kept for the input-dependent nodes the README plans
+                sys.stdout.flush() # the debug output above went through the text layer
+                write_replaced(sys.stdout.buffer, input_, cast(bytes, query.const_value), cast(bytes, replacement.const_value))
+            else:
+                res = ast.visit(input_)
+                sys.stdout.flush()
+                sys.stdout.buffer.write(res)
+            sys.stdout.buffer.write(b"\n")
+    except FindError as e:
+        error(str(e))
 
 if __name__ == "__main__":
     main(sys.argv)
\ No newline at end of file